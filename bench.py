@@ -0,0 +1,204 @@
+import gc
+import sys
+import time
+import timeit
+
+import sympy
+from antlr4 import ParserRuleContext
+from antlr4.Token import CommonToken
+
+try:
+    import tracemalloc
+except ImportError: # Python 2
+    tracemalloc = None
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+import process_latex
+import latex_ast
+from process_latex import process_sympy
+from latex_ast import parse_latex_ast, Node
+from latex_bulk import parse_bulk, dfa_size
+from latex_gen import generate_cases
+
+def big_integrand(n):
+    # x^{1} + x^{2} + ... + x^{n} dx
+    terms = ["x^{%d}" % i for i in range(1, n + 1)]
+    return "\\int " + " + ".join(terms) + " dx"
+
+def big_frac_integrand(n):
+    terms = ["y^{%d}" % i for i in range(1, n + 1)]
+    return "\\int \\frac{" + " + ".join(terms) + " dy}{y}"
+
+def big_eval_at(n):
+    terms = ["%d x^{%d}" % (i, i) for i in range(1, n + 1)]
+    return "(" + " + ".join(terms) + ")|^{x=1}_{x=0}"
+
+CASES = [
+    ("integral, 10 terms", big_integrand(10)),
+    ("integral, 50 terms", big_integrand(50)),
+    ("frac integral, 100 terms", big_frac_integrand(100)),
+    ("eval_at, 10 terms", big_eval_at(10)),
+    ("eval_at, 100 terms", big_eval_at(100)),
+]
+
+def failure(e):
+    lines = str(e).splitlines()
+    return "failed: %s %s" % (type(e).__name__, lines[0] if lines else "")
+
+def bench_cases(cases, number):
+    for name, s in cases:
+        try:
+            t = timeit.timeit(lambda: process_sympy(s), number=number)
+            print("%-30s %10.3f ms/parse" % (name, 1000.0 * t / number))
+        except Exception as e: # e.g. too deep for the parser
+            print("%-30s %s" % (name, failure(e)))
+
+def replace_by_subs(expr, old, new, bound=True):
+    # replace_expr before it used xreplace
+    return expr.subs(old, new)
+
+def timeit_replacing(replace, fn, number):
+    saved = process_latex.replace_expr
+    process_latex.replace_expr = latex_ast.replace_expr = replace
+    try:
+        return timeit.timeit(fn, number=number)
+    finally:
+        process_latex.replace_expr = latex_ast.replace_expr = saved
+
+def convert(ast):
+    for node in ast.walk():
+        node._sympy = None
+    return ast.to_sympy()
+
+def bench_convert(cases, number):
+    """Time to_sympy() alone on a tree parsed up front."""
+    for name, s in cases:
+        print(name)
+        try:
+            ast = parse_latex_ast(s)
+        except Exception as e:
+            print("  %s" % failure(e))
+            continue
+        for mode, replace in (("replace_expr", process_latex.replace_expr),
+                              ("subs", replace_by_subs)):
+            t = timeit_replacing(replace, lambda: convert(ast), number)
+            print("  %-28s %10.3f ms/convert" % (mode, 1000.0 * t / number))
+
+def peak_memory(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def live_objects(fn):
+    """ANTLR contexts and tokens, and AST nodes, still reachable after fn
+    returns if the cyclic garbage collector doesn't run."""
+    gc.collect()
+    gc.disable()
+    try:
+        result = fn()
+        antlr = 0
+        nodes = 0
+        for obj in gc.get_objects():
+            if isinstance(obj, (ParserRuleContext, CommonToken)):
+                antlr += 1
+            elif isinstance(obj, Node):
+                nodes += 1
+        return antlr, nodes
+    finally:
+        result = None
+        gc.enable()
+        gc.collect()
+
+AST_MODES = [
+    ("process_sympy", lambda s: process_sympy(s)),
+    ("ast only", lambda s: parse_latex_ast(s)),
+    ("ast free_symbols", lambda s: parse_latex_ast(s).free_symbols()),
+    ("ast to_sympy", lambda s: parse_latex_ast(s).to_sympy()),
+]
+
+def bench_ast(cases, number):
+    for name, s in cases:
+        print(name)
+        for mode, fn in AST_MODES:
+            try:
+                t = timeit.timeit(lambda: fn(s), number=number)
+            except Exception as e:
+                print("  %-28s %s" % (mode, failure(e)))
+                continue
+            line = "  %-28s %10.3f ms/parse" % (mode, 1000.0 * t / number)
+            line += "  %6d antlr %6d ast objects" % live_objects(lambda: fn(s))
+            if tracemalloc:
+                line += "  %8.1f KiB peak" % (peak_memory(lambda: fn(s)) / 1024.0)
+            print(line)
+
+# pairs of equivalent inputs, as a consumer checking answers would see them
+EQUALITY_PAIRS = [
+    ("\\frac{7}{3} x + 2x - x", "\\frac{10}{3} x"),
+    ("a \\cdot b / a + c - c", "b"),
+    ("(x + 1)(x - 1)", "x^2 - 1"),
+    (" + ".join("%d x^{%d}" % (i, i) for i in range(1, 30)),
+     " + ".join("x^{%d} %d" % (i, i) for i in reversed(range(1, 30)))),
+]
+
+def equal_default(lh, rh):
+    e1 = process_sympy(lh)
+    e2 = process_sympy(rh)
+    return sympy.simplify(e1 - e2) == 0
+
+def equal_evaluated(lh, rh):
+    e1 = process_sympy(lh, evaluate=True)
+    e2 = process_sympy(rh, evaluate=True)
+    # canonical forms usually compare equal directly
+    return e1 == e2 or sympy.simplify(e1 - e2) == 0
+
+def bench_evaluate(pairs, number):
+    for lh, rh in pairs:
+        print(lh[:40])
+        for mode, fn in (("evaluate=False", equal_default),
+                         ("evaluate=True", equal_evaluated)):
+            t = timeit.timeit(lambda: fn(lh, rh), number=number)
+            print("  %-28s %10.3f ms/check" % (mode, 1000.0 * t / number))
+
+def rss_kb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except IOError:
+        # peak rather than current RSS, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def parse_plain(sources):
+    for s in sources:
+        try:
+            yield process_sympy(s)
+        except Exception as e:
+            yield e
+
+def soak(count, every, bulk=True):
+    """Parse count generated expressions, printing RSS every few parses."""
+    sources = (latex for index, kind, latex in
+               generate_cases(seed=0, count=count, invalid=0.1))
+    results = parse_bulk(sources) if bulk else parse_plain(sources)
+    started = time.time()
+    for i, result in enumerate(results, 1):
+        if i % every == 0:
+            print("%10d parses %9.1fs %10d KiB rss %8d dfa states" % (
+                i, time.time() - started, rss_kb(), dfa_size()))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "soak":
+        # python bench.py soak [count] [plain]
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 10000000
+        soak(count, max(1, count // 100), bulk="plain" not in sys.argv[3:])
+        sys.exit(0)
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    bench_cases(CASES, number)
+    bench_convert(CASES, number)
+    bench_ast(CASES, number)
+    bench_evaluate(EQUALITY_PAIRS, number)
@@ -0,0 +1,206 @@
+"""Run parsers over generated expressions in parallel.
+
+Reports throughput and latency percentiles for each implementation and,
+when two are given, every case where their outputs differ:
+
+    python fuzz.py --count 100000 --jobs 8
+    python fuzz.py --count 100000 --impl process_sympy --impl ast
+
+An implementation is "process_sympy", "ast" (parse_latex_ast followed by
+to_sympy) or "module:function" for any callable taking a LaTeX string.
+Outputs are compared with srepr(), and two errors count as the same output
+whatever their messages. Latencies are counted in fixed buckets, so memory
+stays flat however many cases run and percentiles are accurate to within a
+bucket (5%).
+"""
+import argparse
+import importlib
+import math
+import multiprocessing
+import sys
+import time
+
+import sympy
+
+from latex_gen import generate_cases, parse_weight
+
+def ast_to_sympy(latex):
+    from latex_ast import parse_latex_ast
+    return parse_latex_ast(latex).to_sympy()
+
+def load_impl(name):
+    if name == "process_sympy":
+        from process_latex import process_sympy
+        return process_sympy
+    elif name == "ast":
+        return ast_to_sympy
+    module, func = name.split(":")
+    return getattr(importlib.import_module(module), func)
+
+def run_one(impl, latex):
+    start = time.time()
+    try:
+        out = sympy.srepr(impl(latex))
+        ok = True
+    except Exception as e:
+        out = "%s: %s" % (type(e).__name__, str(e).split("\n")[0])
+        ok = False
+    return ok, out, time.time() - start
+
+# latency buckets grow by HIST_GROWTH from HIST_MIN seconds; the last one
+# also holds everything slower
+HIST_MIN = 1e-6
+HIST_GROWTH = 1.05
+HIST_BUCKETS = 400
+
+def bucket(t):
+    if t <= HIST_MIN:
+        return 0
+    i = 1 + int(math.log(t / HIST_MIN) / math.log(HIST_GROWTH))
+    return min(i, HIST_BUCKETS - 1)
+
+def bucket_top(i):
+    return HIST_MIN * HIST_GROWTH ** i
+
+def same_output(a, b):
+    """a and b are (ok, out) results of run_one."""
+    if not a[0] and not b[0]:
+        return True
+    return a[0] == b[0] and a[1] == b[1]
+
+# set in each pool process by init_worker
+worker_impls = None
+worker_config = None
+
+def init_worker(impl_names, config):
+    global worker_impls, worker_config
+    worker_impls = [load_impl(name) for name in impl_names]
+    worker_config = config
+
+def run_chunk(chunk):
+    """Run every implementation over cases [start, start + count)."""
+    start, count = chunk
+    config = dict(worker_config)
+    seed = config.pop("seed")
+    invalid = config.pop("invalid")
+    histograms = [[0] * HIST_BUCKETS for impl in worker_impls]
+    maxima = [0.0 for impl in worker_impls]
+    counts = {}
+    failures = []
+    mismatches = []
+    for index, kind, latex in generate_cases(seed, count, start, invalid, **config):
+        results = [run_one(impl, latex) for impl in worker_impls]
+        for i, (ok, out, t) in enumerate(results):
+            histograms[i][bucket(t)] += 1
+            maxima[i] = max(maxima[i], t)
+            key = (i, kind, ok)
+            counts[key] = counts.get(key, 0) + 1
+        if kind == "valid" and not results[0][0]:
+            failures.append((index, latex, results[0][1]))
+        if len(results) > 1 and not same_output(results[0][:2], results[1][:2]):
+            mismatches.append((index, latex, results[0][1], results[1][1]))
+    return histograms, maxima, counts, failures, mismatches
+
+def chunks(start, count, size):
+    for chunk_start in range(start, start + count, size):
+        yield chunk_start, min(size, start + count - chunk_start)
+
+def percentile(histogram, p):
+    """Upper bound of the bucket holding the p-th percentile."""
+    total = sum(histogram)
+    if not total:
+        return 0.0
+    rank = min(total - 1, int(p / 100.0 * total))
+    seen = 0
+    for i, n in enumerate(histogram):
+        seen += n
+        if seen > rank:
+            return bucket_top(i)
+
+def report(impl_names, histograms, maxima, counts, failures, mismatches, elapsed):
+    """failures and mismatches are (total, first few) pairs."""
+    total = sum(histograms[0])
+    print("%d cases in %.2fs: %.1f cases/s" % (total, elapsed, total / elapsed))
+    for i, name in enumerate(impl_names):
+        print("%s" % name)
+        for kind in ("valid", "mutated"):
+            ok = counts.get((i, kind, True), 0)
+            err = counts.get((i, kind, False), 0)
+            if ok or err:
+                print("  %-8s %8d parsed %8d raised" % (kind, ok, err))
+        # a bucket's upper bound can overshoot the slowest case in it
+        tails = [min(percentile(histograms[i], p), maxima[i])
+                 for p in (50, 90, 99, 99.9)]
+        tails.append(maxima[i])
+        print("  latency  p50 %.3fms  p90 %.3fms  p99 %.3fms  p99.9 %.3fms  max %.3fms"
+            % tuple(1000.0 * t for t in tails))
+    n_failures, failures = failures
+    n_mismatches, mismatches = mismatches
+    if n_failures:
+        print("%d valid cases raised in %s, first %d:" % (
+            n_failures, impl_names[0], len(failures)))
+        for index, latex, out in failures:
+            print("  #%d %s\n    %s" % (index, latex, out))
+    if len(impl_names) > 1:
+        print("%d outputs differ, first %d:" % (n_mismatches, len(mismatches)))
+        for index, latex, a, b in mismatches:
+            print("  #%d %s\n    %s: %s\n    %s: %s" % (index, latex, impl_names[0], a, impl_names[1], b))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run parsers over generated LaTeX.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--count", type=int, default=10000)
+    parser.add_argument("--start", type=int, default=0,
+        help="index of the first case, to resume or reproduce a case")
+    parser.add_argument("--size", type=int, default=20)
+    parser.add_argument("--max-depth", type=int, default=6)
+    parser.add_argument("--invalid", type=float, default=0.1,
+        help="fraction of cases mutated into (usually) invalid input")
+    parser.add_argument("--weight", type=parse_weight, action="append",
+        default=[], metavar="CONSTRUCT=VALUE",
+        help="override a generator weight, 0 turns a construct off; repeatable")
+    parser.add_argument("--impl", action="append",
+        help="implementation to run; give twice to compare two")
+    parser.add_argument("--jobs", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--chunk", type=int, default=500)
+    parser.add_argument("--show", type=int, default=10,
+        help="number of failures and mismatches to print")
+    args = parser.parse_args(argv)
+
+    impl_names = args.impl or ["process_sympy"]
+    if len(impl_names) > 2:
+        parser.error("at most two implementations can be compared")
+    config = {"seed": args.seed, "invalid": args.invalid,
+              "size": args.size, "max_depth": args.max_depth,
+              "weights": dict(args.weight)}
+
+    histograms = [[0] * HIST_BUCKETS for name in impl_names]
+    maxima = [0.0 for name in impl_names]
+    counts = {}
+    # totals, plus the first --show examples of each
+    n_failures = 0
+    n_mismatches = 0
+    failures = []
+    mismatches = []
+    started = time.time()
+    pool = multiprocessing.Pool(args.jobs, init_worker, (impl_names, config))
+    try:
+        for hist, peak, cnt, fail, mism in pool.imap(run_chunk,
+                chunks(args.start, args.count, args.chunk)):
+            for i in range(len(impl_names)):
+                histograms[i] = [a + b for a, b in zip(histograms[i], hist[i])]
+                maxima[i] = max(maxima[i], peak[i])
+            for key, n in cnt.items():
+                counts[key] = counts.get(key, 0) + n
+            n_failures += len(fail)
+            n_mismatches += len(mism)
+            failures.extend(fail[:args.show - len(failures)])
+            mismatches.extend(mism[:args.show - len(mismatches)])
+    finally:
+        pool.terminate()
+    report(impl_names, histograms, maxima, counts, (n_failures, failures),
+        (n_mismatches, mismatches), time.time() - started)
+    return 1 if n_mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
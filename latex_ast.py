@@ -0,0 +1,934 @@
+import sympy
+
+from gen.PSLexer import PSLexer
+
+from sympy.printing.str import StrPrinter
+
+from process_latex import (create_parser, release_parser, state, evaluating,
+    rule2text, get_differential_var_str, combine_postfix_list, combine_eval_at,
+    subs_at, replace_expr, make_func_normal)
+
+
+def parse_latex_ast(src):
+    """Parse a LaTeX string into a compact AST.
+
+    Nodes only keep strings, ints and child nodes, so the ANTLR parse tree
+    and token stream can be freed as soon as this returns. Call
+    ``to_sympy()`` on any node to build (and cache) its SymPy form; it is
+    built unevaluated, or in the mode of the process_sympy call converting
+    it.
+    """
+    parser = create_parser(src)
+
+    tree = None
+    try:
+        tree = parser.math()
+        node = build_relation(tree.relation())
+    finally:
+        release_parser(parser, tree)
+
+    return node
+
+
+class Node(object):
+    """Base class for AST nodes.
+
+    ``start`` and ``stop`` are character offsets into the source string,
+    so ``src[node.start:node.stop]`` is the text the node was built from.
+    """
+    __slots__ = ('start', 'stop', '_sympy')
+    _fields = ()
+
+    def __init__(self, span):
+        self.start, self.stop = span
+        self._sympy = None
+
+    def children(self):
+        for field in self._fields:
+            value = getattr(self, field)
+            if isinstance(value, Node):
+                yield value
+            elif isinstance(value, list):
+                for item in value:
+                    yield item
+
+    def walk(self):
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(list(node.children())))
+
+    def depth(self):
+        return 1 + max([c.depth() for c in self.children()] or [0])
+
+    def function_names(self):
+        return set(n.func_name() for n in self.walk() if isinstance(n, Func))
+
+    def free_symbols(self):
+        """Names of the free symbols of ``to_sympy()``, mostly without building it.
+
+        SymPy simplifies some expressions even when built unevaluated (a
+        derivative of a constant is 0, ``x \\div x`` in a difference is 1),
+        so this can name symbols the built expression has lost.
+        """
+        return self._free()
+
+    def _free(self):
+        free = set()
+        for child in self.children():
+            free |= child._free()
+        return free
+
+    def _symbols(self):
+        # names of all symbols in to_sympy(), bound ones included, like
+        # atoms(Symbol)
+        syms = set()
+        for child in self.children():
+            syms |= child._symbols()
+        return syms
+
+    def to_sympy(self):
+        if self._sympy is None:
+            self._sympy = self._build()
+        return self._sympy
+
+    def __repr__(self):
+        args = ", ".join(repr(getattr(self, f)) for f in self._fields)
+        return "%s(%s)" % (type(self).__name__, args)
+
+
+class Relation(Node):
+    __slots__ = ('op', 'lhs', 'rhs')
+    _fields = ('op', 'lhs', 'rhs')
+
+    def __init__(self, span, op, lhs, rhs):
+        Node.__init__(self, span)
+        self.op = op
+        self.lhs = lhs
+        self.rhs = rhs
+
+    def _build(self):
+        lh = self.lhs.to_sympy()
+        rh = self.rhs.to_sympy()
+        if self.op == '<':
+            return sympy.StrictLessThan(lh, rh)
+        elif self.op == '\\leq':
+            return sympy.LessThan(lh, rh)
+        elif self.op == '>':
+            return sympy.StrictGreaterThan(lh, rh)
+        elif self.op == '\\geq':
+            return sympy.GreaterThan(lh, rh)
+        elif self.op == '=':
+            return sympy.Eq(lh, rh)
+
+
+class Add(Node):
+    __slots__ = ('op', 'lhs', 'rhs')
+    _fields = ('op', 'lhs', 'rhs')
+
+    def __init__(self, span, op, lhs, rhs):
+        Node.__init__(self, span)
+        self.op = op
+        self.lhs = lhs
+        self.rhs = rhs
+
+    def _build(self):
+        if evaluating():
+            # build one n-ary Add instead of re-flattening at every level
+            terms = []
+            self._collect(1, terms)
+            return sympy.Add(*terms)
+        lh = self.lhs.to_sympy()
+        rh = self.rhs.to_sympy()
+        if self.op == '-':
+            rh = -1 * rh
+        return sympy.Add(lh, rh, evaluate=False)
+
+    def _collect(self, sign, terms):
+        rhs_sign = sign if self.op == '+' else -sign
+        for node, node_sign in ((self.lhs, sign), (self.rhs, rhs_sign)):
+            if isinstance(node, Add):
+                node._collect(node_sign, terms)
+            else:
+                term = node.to_sympy()
+                terms.append(term if node_sign > 0 else -term)
+
+
+class Mul(Node):
+    __slots__ = ('op', 'lhs', 'rhs')
+    _fields = ('op', 'lhs', 'rhs')
+
+    def __init__(self, span, op, lhs, rhs):
+        Node.__init__(self, span)
+        self.op = op
+        self.lhs = lhs
+        self.rhs = rhs
+
+    def _build(self):
+        if evaluating():
+            # build one n-ary Mul instead of re-flattening at every level
+            factors = []
+            self._collect(False, factors)
+            return sympy.Mul(*factors)
+        lh = self.lhs.to_sympy()
+        rh = self.rhs.to_sympy()
+        if self.op == '/':
+            rh = sympy.Pow(rh, -1, evaluate=False)
+        return sympy.Mul(lh, rh, evaluate=False)
+
+    def _collect(self, inverted, factors):
+        rhs_inverted = not inverted if self.op == '/' else inverted
+        for node, node_inverted in ((self.lhs, inverted), (self.rhs, rhs_inverted)):
+            if isinstance(node, Mul):
+                node._collect(node_inverted, factors)
+            else:
+                factor = node.to_sympy()
+                factors.append(sympy.Pow(factor, -1) if node_inverted else factor)
+
+
+class Neg(Node):
+    __slots__ = ('operand',)
+    _fields = ('operand',)
+
+    def __init__(self, span, operand):
+        Node.__init__(self, span)
+        self.operand = operand
+
+    def _build(self):
+        return sympy.Mul(-1, self.operand.to_sympy(), evaluate=evaluating())
+
+
+class Postfix(Node):
+    """Implicit multiplication, e.g. ``2 x \\sin y``."""
+    __slots__ = ('items',)
+    _fields = ('items',)
+
+    def __init__(self, span, items):
+        Node.__init__(self, span)
+        self.items = items
+
+    def _build(self):
+        return combine_postfix_list(self.items, lambda n: n.to_sympy())
+
+    def _free(self):
+        free = set()
+        items = self.items
+        for i, item in enumerate(items):
+            # mirrors combine_postfix_list: 'x' between two constants is a
+            # multiplication sign, not a symbol
+            if (0 < i < len(items) - 1 and isinstance(item, Atom) and
+                item.kind == 'symbol' and item.name() == 'x' and
+                not isinstance(items[i - 1], DiffOp) and
+                not isinstance(items[i + 1], DiffOp) and
+                not items[i - 1]._symbols() and not items[i + 1]._symbols()):
+                continue
+            free |= item._free()
+        return free
+
+
+class Factorial(Node):
+    __slots__ = ('operand',)
+    _fields = ('operand',)
+
+    def __init__(self, span, operand):
+        Node.__init__(self, span)
+        self.operand = operand
+
+    def _build(self):
+        return sympy.factorial(self.operand.to_sympy(), evaluate=evaluating())
+
+
+class EvalAt(Node):
+    """``operand|^{sup}_{sub}``; sup and sub are a Relation for ``x=a``."""
+    __slots__ = ('operand', 'sup', 'sub', 'bound')
+    _fields = ('operand', 'sup', 'sub')
+
+    def __init__(self, span, operand, sup, sub, bound=True):
+        Node.__init__(self, span)
+        self.operand = operand
+        self.sup = sup
+        self.sub = sub
+        # whether the operand holds a node that binds a variable
+        self.bound = bound
+
+    def _build(self):
+        exp = self.operand.to_sympy()
+        at_b = None
+        at_a = None
+        if self.sup is not None:
+            at_b = self._subs(exp, self.sup)
+        if self.sub is not None:
+            at_a = self._subs(exp, self.sub)
+        return combine_eval_at(exp, at_b, at_a)
+
+    def _subs(self, exp, at):
+        if isinstance(at, Relation):
+            return replace_expr(exp, at.lhs.to_sympy(), at.rhs.to_sympy(),
+                self.bound)
+        return subs_at(exp, at.to_sympy(), self.bound)
+
+    def _free(self):
+        if self._needs_subs():
+            return set(str(sym) for sym in self.to_sympy().free_symbols)
+        return self._substituted(lambda node: node._free())
+
+    def _symbols(self):
+        if self._needs_subs():
+            return set(str(sym) for sym in self.to_sympy().atoms(sympy.Symbol))
+        return self._substituted(lambda node: node._symbols())
+
+    def _needs_subs(self):
+        # substituting for something other than a plain symbol, or into an
+        # expression that binds variables, goes through subs(), which only
+        # the built expression can answer for
+        for at in (self.sup, self.sub):
+            if isinstance(at, Relation) and not (isinstance(at.lhs, Atom) and
+                at.lhs.kind == 'symbol'):
+                return True
+        return self.bound and (self.sup is not None or self.sub is not None)
+
+    def _substituted(self, query):
+        # query(node) gives a set of names; returns the names left after
+        # substituting sup and sub into the operand
+        base = query(self.operand)
+        if self.sup is None and self.sub is None:
+            return base
+        names = set()
+        for at in (self.sup, self.sub):
+            if at is not None:
+                names |= self._substituted_at(base, at, query)
+        return names
+
+    def _substituted_at(self, base, at, query):
+        if isinstance(at, Relation):
+            name = at.lhs.name()
+            if name in base:
+                return (base - set([name])) | query(at.rhs)
+            return set(base)
+        # subs_at picks from all the symbols of the point, bound ones too
+        at_syms = at._symbols()
+        if not at_syms:
+            return set(base)
+        sym = min(at_syms)
+        if sym in base:
+            return (base - set([sym])) | query(at)
+        return set(base)
+
+
+class Pow(Node):
+    __slots__ = ('base', 'exponent')
+    _fields = ('base', 'exponent')
+
+    def __init__(self, span, base, exponent):
+        Node.__init__(self, span)
+        self.base = base
+        self.exponent = exponent
+
+    def _build(self):
+        return sympy.Pow(self.base.to_sympy(), self.exponent.to_sympy(),
+            evaluate=evaluating())
+
+
+class Abs(Node):
+    __slots__ = ('operand',)
+    _fields = ('operand',)
+
+    def __init__(self, span, operand):
+        Node.__init__(self, span)
+        self.operand = operand
+
+    def _build(self):
+        return sympy.Abs(self.operand.to_sympy(), evaluate=evaluating())
+
+
+class Frac(Node):
+    __slots__ = ('upper', 'lower')
+    _fields = ('upper', 'lower')
+
+    def __init__(self, span, upper, lower):
+        Node.__init__(self, span)
+        self.upper = upper
+        self.lower = lower
+
+    def _build(self):
+        top = self.upper.to_sympy()
+        bot = self.lower.to_sympy()
+        return sympy.Mul(top, sympy.Pow(bot, -1, evaluate=evaluating()),
+            evaluate=evaluating())
+
+
+class DiffOp(Node):
+    """A bare ``\\frac{d}{dx}`` operator applied to what follows it."""
+    __slots__ = ('wrt',)
+    _fields = ('wrt',)
+
+    def __init__(self, span, wrt):
+        Node.__init__(self, span)
+        self.wrt = wrt
+
+    def _build(self):
+        return [sympy.Symbol(self.wrt)]
+
+    def _symbols(self):
+        return set([self.wrt])
+
+
+class Derivative(Node):
+    """``\\frac{d expr}{dx}``, with expr parsed from the numerator text."""
+    __slots__ = ('expr', 'wrt')
+    _fields = ('expr', 'wrt')
+
+    def __init__(self, span, expr, wrt):
+        Node.__init__(self, span)
+        self.expr = expr
+        self.wrt = wrt
+
+    def _build(self):
+        return sympy.Derivative(self.expr.to_sympy(), sympy.Symbol(self.wrt))
+
+    def _symbols(self):
+        return self.expr._symbols() | set([self.wrt])
+
+
+class Func(Node):
+    """A function call.
+
+    ``kind`` is 'normal' for built-in functions like ``\\sin`` (``sub`` is
+    the log base, ``sup`` the power), 'user' for ``f(x, y)`` (``sub`` is the
+    name subscript) and 'sqrt' (``args`` is ``[base]`` or ``[base, root]``).
+    """
+    __slots__ = ('kind', 'name', 'args', 'sub', 'sup')
+    _fields = ('kind', 'name', 'args', 'sub', 'sup')
+
+    def __init__(self, span, kind, name, args, sub=None, sup=None):
+        Node.__init__(self, span)
+        self.kind = kind
+        self.name = name
+        self.args = args
+        self.sub = sub
+        self.sup = sup
+
+    def func_name(self):
+        if self.kind == 'user' and self.sub is not None:
+            return self.name + '_{' + subscript_name(self.sub) + '}'
+        return self.name
+
+    def _build(self):
+        args = [a.to_sympy() for a in self.args]
+        if self.kind == 'normal':
+            base = self.sub.to_sympy() if self.sub is not None else None
+            func_pow = self.sup.to_sympy() if self.sup is not None else None
+            return make_func_normal(self.name, args[0], base, func_pow)
+        elif self.kind == 'user':
+            return sympy.Function(self.func_name())(*args)
+        elif self.kind == 'sqrt':
+            if len(args) > 1:
+                return sympy.root(args[0], args[1])
+            return sympy.sqrt(args[0])
+
+    def _free(self):
+        return self._names(lambda node: node._free())
+
+    def _symbols(self):
+        return self._names(lambda node: node._symbols())
+
+    def _names(self, query):
+        # a user function's subscript is part of its name, not an argument
+        names = set()
+        for arg in self.args:
+            names |= query(arg)
+        if self.kind == 'normal':
+            for extra in (self.sub, self.sup):
+                if extra is not None:
+                    names |= query(extra)
+        return names
+
+
+class Integral(Node):
+    """``diff`` names the differential symbol stripped from the integrand."""
+    __slots__ = ('integrand', 'var', 'diff', 'lower', 'upper', 'bound')
+    _fields = ('integrand', 'var', 'diff', 'lower', 'upper')
+
+    def __init__(self, span, integrand, var, diff=None, lower=None, upper=None,
+            bound=True):
+        Node.__init__(self, span)
+        self.integrand = integrand
+        self.var = var
+        self.diff = diff
+        self.lower = lower
+        self.upper = upper
+        # whether the integrand holds a node that binds a variable
+        self.bound = bound
+
+    def _build(self):
+        if self.integrand is not None:
+            integrand = self.integrand.to_sympy()
+        else:
+            integrand = 1
+        if self.diff is not None:
+            integrand = replace_expr(integrand, sympy.Symbol(self.diff), 1,
+                self.bound)
+        int_var = sympy.Symbol(self.var)
+        if self.lower is not None:
+            lower = self.lower.to_sympy()
+            upper = self.upper.to_sympy()
+            return sympy.Integral(integrand, (int_var, lower, upper))
+        else:
+            return sympy.Integral(integrand, int_var)
+
+    def _free(self):
+        free = set()
+        if self.integrand is not None:
+            free = self.integrand._free()
+        free.discard(self.diff)
+        if self.lower is None:
+            free.add(self.var)
+            return free
+        free.discard(self.var)
+        return free | self.lower._free() | self.upper._free()
+
+    def _symbols(self):
+        syms = set()
+        if self.integrand is not None:
+            syms = self.integrand._symbols()
+        syms.discard(self.diff)
+        syms.add(self.var)
+        if self.lower is not None:
+            syms |= self.lower._symbols() | self.upper._symbols()
+        return syms
+
+
+class SumProd(Node):
+    """``kind`` is 'summation' or 'product'."""
+    __slots__ = ('kind', 'body', 'var', 'lower', 'upper')
+    _fields = ('kind', 'body', 'var', 'lower', 'upper')
+
+    def __init__(self, span, kind, body, var, lower, upper):
+        Node.__init__(self, span)
+        self.kind = kind
+        self.body = body
+        self.var = var
+        self.lower = lower
+        self.upper = upper
+
+    def _build(self):
+        limits = (self.var.to_sympy(), self.lower.to_sympy(),
+            self.upper.to_sympy())
+        if self.kind == 'summation':
+            return sympy.Sum(self.body.to_sympy(), limits)
+        elif self.kind == 'product':
+            return sympy.Product(self.body.to_sympy(), limits)
+
+    def _free(self):
+        free = self.body._free() - self.var._free()
+        return free | self.lower._free() | self.upper._free()
+
+
+class Limit(Node):
+    __slots__ = ('body', 'var', 'approaching', 'direction')
+    _fields = ('body', 'var', 'approaching', 'direction')
+
+    def __init__(self, span, body, var, approaching, direction):
+        Node.__init__(self, span)
+        self.body = body
+        self.var = var
+        self.approaching = approaching
+        self.direction = direction
+
+    def _build(self):
+        return sympy.Limit(self.body.to_sympy(), sympy.Symbol(self.var),
+            self.approaching.to_sympy(), self.direction)
+
+    def _free(self):
+        free = self.body._free()
+        free.discard(self.var)
+        return free | self.approaching._free()
+
+    def _symbols(self):
+        return (self.body._symbols() | set([self.var]) |
+            self.approaching._symbols())
+
+
+class Atom(Node):
+    """``kind`` is 'symbol', 'number', 'infty' or 'differential'.
+
+    For a differential ``text`` is the variable, so ``d\\theta`` has text
+    'theta'. Symbols may carry a subscript node in ``sub``.
+    """
+    __slots__ = ('kind', 'text', 'sub')
+    _fields = ('kind', 'text', 'sub')
+
+    def __init__(self, span, kind, text, sub=None):
+        Node.__init__(self, span)
+        self.kind = kind
+        self.text = text
+        self.sub = sub
+
+    def name(self):
+        if self.kind == 'differential':
+            return 'd' + self.text
+        if self.sub is not None:
+            return self.text + '_{' + subscript_name(self.sub) + '}'
+        return self.text
+
+    def _build(self):
+        if self.kind == 'number':
+            return sympy.Number(self.text)
+        elif self.kind == 'infty':
+            return sympy.oo
+        else:
+            return sympy.Symbol(self.name())
+
+    def _free(self):
+        if self.kind == 'symbol' or self.kind == 'differential':
+            return set([self.name()])
+        return set()
+
+    def _symbols(self):
+        return self._free()
+
+
+def subscript_name(sub):
+    return StrPrinter().doprint(sub.to_sympy())
+
+def span(ctx):
+    return (ctx.start.start, ctx.stop.stop + 1)
+
+def build_relation(rel):
+    if rel.expr():
+        return build_expr(rel.expr())
+
+    lh = build_relation(rel.relation(0))
+    rh = build_relation(rel.relation(1))
+    if rel.LT():
+        op = '<'
+    elif rel.LTE():
+        op = '\\leq'
+    elif rel.GT():
+        op = '>'
+    elif rel.GTE():
+        op = '\\geq'
+    elif rel.EQUAL():
+        op = '='
+    return Relation(span(rel), op, lh, rh)
+
+def build_expr(expr):
+    return build_add(expr.additive())
+
+def build_equality(eq):
+    lh = build_expr(eq.expr(0))
+    rh = build_expr(eq.expr(1))
+    return Relation(span(eq), '=', lh, rh)
+
+def build_add(add):
+    if add.ADD() or add.SUB():
+        lh = build_add(add.additive(0))
+        rh = build_add(add.additive(1))
+        op = '+' if add.ADD() else '-'
+        return Add(span(add), op, lh, rh)
+    else:
+        return build_mp(add.mp())
+
+def build_mp(mp):
+    if hasattr(mp, 'mp'):
+        mp_left = mp.mp(0)
+        mp_right = mp.mp(1)
+    else:
+        mp_left = mp.mp_nofunc(0)
+        mp_right = mp.mp_nofunc(1)
+
+    if mp.MUL() or mp.CMD_TIMES() or mp.CMD_CDOT():
+        return Mul(span(mp), '*', build_mp(mp_left), build_mp(mp_right))
+    elif mp.DIV() or mp.CMD_DIV() or mp.COLON():
+        return Mul(span(mp), '/', build_mp(mp_left), build_mp(mp_right))
+    else:
+        if hasattr(mp, 'unary'):
+            return build_unary(mp.unary())
+        else:
+            return build_unary(mp.unary_nofunc())
+
+def build_unary(unary):
+    if hasattr(unary, 'unary'):
+        nested_unary = unary.unary()
+    else:
+        nested_unary = unary.unary_nofunc()
+    if hasattr(unary, 'postfix_nofunc'):
+        first = unary.postfix()
+        tail = unary.postfix_nofunc()
+        postfix = [first] + tail
+    else:
+        postfix = unary.postfix()
+
+    if unary.ADD():
+        return build_unary(nested_unary)
+    elif unary.SUB():
+        return Neg(span(unary), build_unary(nested_unary))
+    elif postfix:
+        items = [build_postfix(p) for p in postfix]
+        if isinstance(items[-1], DiffOp):
+            raise Exception("Expected expression for derivative")
+        if len(items) == 1:
+            return items[0]
+        return Postfix(span(unary), items)
+
+def build_postfix(postfix):
+    if hasattr(postfix, 'exp'):
+        exp_nested = postfix.exp()
+    else:
+        exp_nested = postfix.exp_nofunc()
+
+    binders = state.binders
+    exp = build_exp(exp_nested)
+    bound = state.binders != binders
+    for op in postfix.postfix_op():
+        op_span = (exp.start, op.stop.stop + 1)
+        if op.BANG():
+            if isinstance(exp, DiffOp):
+                raise Exception("Cannot apply postfix to derivative")
+            exp = Factorial(op_span, exp)
+        elif op.eval_at():
+            ev = op.eval_at()
+            sup = None
+            sub = None
+            if ev.eval_at_sup():
+                sup = build_eval_at_side(ev.eval_at_sup())
+            if ev.eval_at_sub():
+                sub = build_eval_at_side(ev.eval_at_sub())
+            exp = EvalAt(op_span, exp, sup, sub, bound)
+
+    return exp
+
+def build_eval_at_side(at):
+    if at.expr():
+        return build_expr(at.expr())
+    elif at.equality():
+        return build_equality(at.equality())
+
+def build_exp(exp):
+    if hasattr(exp, 'exp'):
+        exp_nested = exp.exp()
+    else:
+        exp_nested = exp.exp_nofunc()
+
+    if exp_nested:
+        base = build_exp(exp_nested)
+        if isinstance(base, DiffOp):
+            raise Exception("Cannot raise derivative to power")
+        if exp.atom():
+            exponent = build_atom(exp.atom())
+        elif exp.expr():
+            exponent = build_expr(exp.expr())
+        return Pow(span(exp), base, exponent)
+    else:
+        if hasattr(exp, 'comp'):
+            return build_comp(exp.comp())
+        else:
+            return build_comp(exp.comp_nofunc())
+
+def build_comp(comp):
+    if comp.group():
+        return build_expr(comp.group().expr())
+    elif comp.abs_group():
+        return Abs(span(comp), build_expr(comp.abs_group().expr()))
+    elif comp.atom():
+        return build_atom(comp.atom())
+    elif comp.frac():
+        return build_frac(comp.frac())
+    elif comp.func():
+        return build_func(comp.func())
+
+def build_subexpr(sub):
+    if sub.expr():
+        return build_expr(sub.expr())
+    else:
+        return build_atom(sub.atom())
+
+def build_atom(atom):
+    if atom.LETTER() or atom.SYMBOL():
+        if atom.LETTER():
+            text = atom.LETTER().getText()
+        else:
+            text = atom.SYMBOL().getText()[1:]
+            if text == "infty":
+                return Atom(span(atom), 'infty', text)
+        sub = None
+        if atom.subexpr():
+            sub = build_subexpr(atom.subexpr())
+        return Atom(span(atom), 'symbol', text, sub)
+    elif atom.NUMBER():
+        text = atom.NUMBER().getText().replace(",", "")
+        return Atom(span(atom), 'number', text)
+    elif atom.DIFFERENTIAL():
+        text = get_differential_var_str(atom.DIFFERENTIAL().getText())
+        node = Atom(span(atom), 'differential', text)
+        differentials = state.differentials
+        if differentials:
+            # record it for the innermost integral being built
+            differentials[-1].append(node)
+        return node
+    elif atom.mathit():
+        text = rule2text(atom.mathit().mathit_text())
+        return Atom(span(atom), 'symbol', text)
+
+def build_frac(frac):
+    diff_op = False
+    partial_op = False
+    lower_itv = frac.lower.getSourceInterval()
+    lower_itv_len = lower_itv[1] - lower_itv[0] + 1
+    if (frac.lower.start == frac.lower.stop and
+        frac.lower.start.type == PSLexer.DIFFERENTIAL):
+        wrt = get_differential_var_str(frac.lower.start.text)
+        diff_op = True
+    elif (lower_itv_len == 2 and
+        frac.lower.start.type == PSLexer.SYMBOL and
+        frac.lower.start.text == '\\partial' and
+        (frac.lower.stop.type == PSLexer.LETTER or frac.lower.stop.type == PSLexer.SYMBOL)):
+        partial_op = True
+        wrt = frac.lower.stop.text
+        if frac.lower.stop.type == PSLexer.SYMBOL:
+            wrt = wrt[1:]
+
+    if diff_op or partial_op:
+        if (diff_op and frac.upper.start == frac.upper.stop and
+            frac.upper.start.type == PSLexer.LETTER and
+            frac.upper.start.text == 'd'):
+            state.binders += 1
+            return DiffOp(span(frac), wrt)
+        elif (partial_op and frac.upper.start == frac.upper.stop and
+            frac.upper.start.type == PSLexer.SYMBOL and
+            frac.upper.start.text == '\\partial'):
+            state.binders += 1
+            return DiffOp(span(frac), wrt)
+        upper_text = rule2text(frac.upper)
+
+        skip = None
+        if diff_op and upper_text.startswith('d'):
+            skip = 1
+        elif partial_op and frac.upper.start.text == '\\partial':
+            skip = len('\\partial')
+        if skip is not None:
+            expr_top = parse_latex_ast(upper_text[skip:])
+            # spans of the re-parsed numerator are relative to its own text
+            offset = frac.upper.start.start + skip
+            for node in expr_top.walk():
+                node.start += offset
+                node.stop += offset
+            state.binders += 1
+            return Derivative(span(frac), expr_top, wrt)
+
+    return Frac(span(frac), build_expr(frac.upper), build_expr(frac.lower))
+
+def build_func(func):
+    if func.func_normal():
+        if func.L_PAREN(): # function called with parenthesis
+            arg = build_func_arg(func.func_arg())
+        else:
+            arg = build_func_arg(func.func_arg_noparens())
+
+        name = func.func_normal().start.text[1:]
+
+        base = None
+        if func.subexpr() and name in ["log", "ln"]:
+            base = build_expr(func.subexpr().expr())
+
+        func_pow = None
+        if func.supexpr():
+            func_pow = build_subexpr(func.supexpr())
+
+        return Func(span(func), 'normal', name, [arg], base, func_pow)
+    elif func.LETTER() or func.SYMBOL():
+        if func.LETTER():
+            fname = func.LETTER().getText()
+        elif func.SYMBOL():
+            fname = func.SYMBOL().getText()[1:]
+        fname = str(fname) # can't be unicode
+        sub = None
+        if func.subexpr():
+            sub = build_subexpr(func.subexpr())
+        input_args = func.args()
+        output_args = []
+        while input_args.args():                        # handle multiple arguments to function
+            output_args.append(build_expr(input_args.expr()))
+            input_args = input_args.args()
+        output_args.append(build_expr(input_args.expr()))
+        return Func(span(func), 'user', fname, output_args, sub)
+    elif func.FUNC_INT():
+        return build_integral(func)
+    elif func.FUNC_SQRT():
+        args = [build_expr(func.base)]
+        if func.root:
+            args.append(build_expr(func.root))
+        return Func(span(func), 'sqrt', 'sqrt', args)
+    elif func.FUNC_SUM():
+        return build_sum_or_prod(func, "summation")
+    elif func.FUNC_PROD():
+        return build_sum_or_prod(func, "product")
+    elif func.FUNC_LIM():
+        return build_limit(func)
+
+def build_func_arg(arg):
+    if hasattr(arg, 'expr'):
+        return build_expr(arg.expr())
+    else:
+        return build_mp(arg.mp_nofunc())
+
+def build_integral(func):
+    binders = state.binders
+    differentials = state.differentials
+    differentials.append([])
+    try:
+        if func.additive():
+            integrand = build_add(func.additive())
+        elif func.frac():
+            integrand = build_frac(func.frac())
+        else:
+            integrand = None
+    finally:
+        seen = differentials.pop()
+    bound = state.binders != binders
+    state.binders += 1
+
+    diff = None
+    if func.DIFFERENTIAL():
+        int_var = get_differential_var_str(func.DIFFERENTIAL().getText())
+    elif seen:
+        int_var = seen[-1].text
+        diff = seen[-1].name()
+    else:
+        # Assume dx by default
+        int_var = 'x'
+
+    lower = None
+    upper = None
+    if func.subexpr():
+        lower = build_subexpr(func.subexpr())
+        upper = build_subexpr(func.supexpr())
+    return Integral(span(func), integrand, int_var, diff, lower, upper, bound)
+
+def build_sum_or_prod(func, name):
+    val      = build_mp(func.mp())
+    iter_var = build_expr(func.subeq().equality().expr(0))
+    start    = build_expr(func.subeq().equality().expr(1))
+    end      = build_subexpr(func.supexpr())
+
+    state.binders += 1
+    return SumProd(span(func), name, val, iter_var, start, end)
+
+def build_limit(func):
+    sub = func.limit_sub()
+    if sub.LETTER():
+        var = sub.LETTER().getText()
+    elif sub.SYMBOL():
+        var = sub.SYMBOL().getText()[1:]
+    else:
+        var = 'x'
+    if sub.SUB():
+        direction = "-"
+    else:
+        direction = "+"
+    approaching = build_expr(sub.expr())
+    content     = build_mp(func.mp())
+
+    state.binders += 1
+    return Limit(span(func), content, var, approaching, direction)
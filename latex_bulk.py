@@ -0,0 +1,78 @@
+"""Parse large batches of LaTeX in one process without letting memory creep.
+
+    from latex_bulk import parse_bulk
+
+    for result in parse_bulk(open("exprs.txt")):
+        if isinstance(result, Exception):
+            ...
+
+Every parse already tears down its parser state as soon as it is built
+(see release_parser). On top of calling process_sympy in a loop, returned
+errors carry no traceback (and so no parser frames), and the DFA cache that
+ANTLR shares between all parsers is thrown away once it grows past a limit.
+"""
+import sys
+
+from antlr4.dfa.DFA import DFA
+from antlr4.PredictionContext import PredictionContextCache
+
+from gen.PSParser import PSParser
+from gen.PSLexer import PSLexer
+
+from process_latex import process_sympy
+
+# total DFA states above which the shared caches are reset
+MAX_DFA_STATES = 50000
+
+def parse_bulk(sources, evaluate=None, max_dfa_states=MAX_DFA_STATES,
+               check_every=1000):
+    """Yield process_sympy's result for each source, or the exception it raised.
+
+    The DFA size is checked every check_every parses; pass
+    max_dfa_states=None to never reset it.
+    """
+    for i, src in enumerate(sources):
+        try:
+            result = process_sympy(src, evaluate)
+        except Exception as e:
+            strip_traceback(e)
+            result = e
+        yield result
+        result = None
+
+        if (max_dfa_states is not None and (i + 1) % check_every == 0 and
+            dfa_size() > max_dfa_states):
+            reset_dfa()
+
+def strip_traceback(e):
+    # Python 3 keeps the traceback on the exception (and on any exception
+    # it was raised from or while handling); Python 2 keeps it in
+    # sys.exc_info()
+    if hasattr(e, '__traceback__'):
+        stack = [e]
+        seen = set()
+        while stack:
+            e = stack.pop()
+            if e is None or id(e) in seen:
+                continue
+            seen.add(id(e))
+            e.__traceback__ = None
+            stack.append(e.__cause__)
+            stack.append(e.__context__)
+    elif hasattr(sys, 'exc_clear'):
+        sys.exc_clear()
+
+def dfa_size():
+    """Number of DFA states cached by the lexer and parser."""
+    dfas = PSParser.decisionsToDFA + PSLexer.decisionsToDFA
+    return sum(len(dfa._states) for dfa in dfas)
+
+def reset_dfa():
+    """Drop the DFA and prediction context caches shared by all parsers.
+
+    Parsers created afterwards start from empty caches and rebuild them as
+    they go, so the first parses after a reset are slower.
+    """
+    PSParser.decisionsToDFA = [DFA(ds, i) for i, ds in enumerate(PSParser.atn.decisionToState)]
+    PSParser.sharedContextCache = PredictionContextCache()
+    PSLexer.decisionsToDFA = [DFA(ds, i) for i, ds in enumerate(PSLexer.atn.decisionToState)]
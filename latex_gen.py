@@ -0,0 +1,368 @@
+"""Random LaTeX expressions following the rules in PS.g4.
+
+Every case is generated from its own RNG seeded with (seed, index), so any
+single case can be regenerated without replaying the ones before it, and
+cases can be split across processes. Only ``Random.random()`` is used, so
+a seed gives the same cases on Python 2 and 3.
+
+    for index, kind, latex in generate_cases(seed=1, count=1000):
+        ...
+"""
+import argparse
+import random
+import sys
+
+# 'd' is left out: the lexer turns 'd' followed by a letter into a
+# differential
+LETTERS = "abcefghijklmnpqrstuvwxyzABCEFGHIJKLMNPQRSTUVWXYZ"
+GREEK = ["\\alpha", "\\beta", "\\gamma", "\\theta", "\\lambda", "\\mu",
+    "\\pi", "\\sigma", "\\phi", "\\omega"]
+WORDS = ["test", "HELLO", "var", "rate", "xyz"]
+
+FUNCS = ["\\sin", "\\cos", "\\tan", "\\csc", "\\sec", "\\cot",
+    "\\arcsin", "\\arccos", "\\arctan", "\\arccsc", "\\arcsec", "\\arccot",
+    "\\sinh", "\\cosh", "\\tanh", "\\arsinh", "\\arcosh", "\\artanh",
+    "\\log", "\\ln"]
+MUL_OPS = ["\\cdot", "\\times", "*", "/", "\\div", ":"]
+REL_OPS = ["=", "<", "\\leq", ">", "\\geq"]
+LIM_APPROACH = ["\\to", "\\rightarrow", "\\Rightarrow", "\\longrightarrow",
+    "\\Longrightarrow"]
+
+# relative weight of each composite construct against a plain atom
+DEFAULT_WEIGHTS = {
+    "atom": 6.0,
+    "subscript": 1.0,
+    "pow": 1.5,
+    "frac": 1.0,
+    "func": 1.5,
+    "user_func": 0.5,
+    "sqrt": 0.5,
+    "abs": 0.5,
+    "factorial": 0.3,
+    "group": 1.0,
+    "int": 0.4,
+    "sum": 0.3,
+    "lim": 0.3,
+    "deriv": 0.3,
+    "eval_at": 0.3,
+    "neg": 0.5,
+}
+
+# fragments spliced into valid expressions to produce invalid ones
+BAD_TOKENS = ["{", "}", "(", ")", "[", "]", "|", "^", "_", "!", ",", "=",
+    "+", "-", "\\frac", "\\int", "\\sqrt", "\\", "@", "#", "$", "&", "~",
+    "\\mathit{1}"]
+
+
+class ExprGenerator(object):
+    """Builds one expression at a time from an RNG.
+
+    ``size`` is a soft bound on the number of leaves, ``max_depth`` the nesting of
+    composite constructs and ``max_width`` the number of terms joined at one
+    level. ``weights`` overrides entries of DEFAULT_WEIGHTS; set a
+    construct's weight to 0 to turn it off.
+    """
+
+    def __init__(self, rng, size=20, max_depth=6, max_width=4, weights=None,
+                 relations=0.2):
+        self.rng = rng
+        self.size = size
+        self.max_depth = max_depth
+        self.max_width = max_width
+        self.relations = relations
+        self.weights = dict(DEFAULT_WEIGHTS)
+        if weights:
+            self.weights.update(weights)
+        self.budget = size
+
+    # helpers that only call rng.random(), see module docstring
+    def chance(self, p):
+        return self.rng.random() < p
+
+    def randint(self, a, b):
+        return a + int(self.rng.random() * (b - a + 1))
+
+    def choice(self, seq):
+        return seq[int(self.rng.random() * len(seq))]
+
+    def weighted(self, names):
+        total = sum(self.weights[n] for n in names)
+        r = self.rng.random() * total
+        for n in names:
+            r -= self.weights[n]
+            if r < 0:
+                return n
+        return names[0]
+
+    # math: relation
+    def math(self):
+        self.budget = self.size
+        if self.chance(self.relations):
+            return "%s %s %s" % (self.expr(0), self.choice(REL_OPS), self.expr(0))
+        return self.expr(0)
+
+    # expr: additive
+    def expr(self, depth):
+        terms = [self.mp(depth)]
+        for i in range(self.randint(0, self.max_width - 1)):
+            if self.budget <= 0:
+                break
+            terms.append(self.choice(["+", "-"]))
+            terms.append(self.mp(depth))
+        return " ".join(terms)
+
+    # mp: mp (MUL | ...) mp | unary
+    def mp(self, depth):
+        factors = [self.unary(depth)]
+        for i in range(self.randint(0, self.max_width - 1)):
+            if self.budget <= 0:
+                break
+            factors.append(self.choice(MUL_OPS))
+            factors.append(self.unary(depth))
+        return " ".join(factors)
+
+    # unary: (ADD | SUB) unary | postfix+
+    def unary(self, depth):
+        if self.chance(0.1 * self.weights["neg"]):
+            return self.choice(["-", "+"]) + self.unary(depth)
+        parts = [self.postfix(depth)]
+        for i in range(self.randint(0, self.max_width - 2)):
+            if self.budget <= 0:
+                break
+            parts.append(self.postfix(depth))
+        return " ".join(parts)
+
+    # postfix: exp postfix_op*
+    def postfix(self, depth):
+        return self.exp(depth)
+
+    def leaf_only(self, depth):
+        return self.budget <= 0 or depth >= self.max_depth
+
+    # exp: exp CARET (atom | L_BRACE expr R_BRACE) | comp
+    def exp(self, depth):
+        if self.leaf_only(depth):
+            return self.atom(depth)
+        kinds = [k for k in sorted(self.weights) if k != "neg"]
+        if depth > 0:
+            # the parser only reads an eval_at's bar reliably at the top
+            # level; inside braces, arguments, scripts or |...| it fails
+            kinds.remove("eval_at")
+        kind = self.weighted(kinds)
+        if kind == "atom":
+            return self.atom(depth)
+        elif kind == "subscript":
+            return self.subscripted(depth)
+        elif kind == "pow":
+            base = self.choice([self.atom, self.group])(depth + 1)
+            return base + "^" + self.script(depth + 1)
+        elif kind == "frac":
+            return "\\frac{%s}{%s}" % (self.expr(depth + 1), self.expr(depth + 1))
+        elif kind == "func":
+            return self.func(depth + 1)
+        elif kind == "user_func":
+            name = self.choice(["f", "g", "h"])
+            args = [self.expr(depth + 1) for i in range(self.randint(1, 3))]
+            return "%s(%s)" % (name, ", ".join(args))
+        elif kind == "sqrt":
+            if self.chance(0.3):
+                return "\\sqrt[%s]{%s}" % (self.expr(depth + 1), self.expr(depth + 1))
+            return "\\sqrt{%s}" % self.expr(depth + 1)
+        elif kind == "abs":
+            return "|%s|" % self.expr(depth + 1)
+        elif kind == "factorial":
+            return self.choice([self.atom, self.group])(depth + 1) + "!"
+        elif kind == "group":
+            return self.group(depth + 1)
+        elif kind == "int":
+            return "(%s)" % self.integral(depth + 1)
+        elif kind == "sum":
+            return "(%s)" % self.sum_or_prod(depth + 1)
+        elif kind == "lim":
+            return "(%s)" % self.limit(depth + 1)
+        elif kind == "deriv":
+            return "(%s)" % self.derivative(depth + 1)
+        elif kind == "eval_at":
+            return self.eval_at(depth + 1)
+
+    def script(self, depth):
+        # supexpr/subexpr: (atom | L_BRACE expr R_BRACE)
+        if self.chance(0.5):
+            return self.simple_atom()
+        return "{%s}" % self.expr(depth)
+
+    def group(self, depth):
+        left, right = self.choice([("(", ")"), ("[", "]"), ("{", "}")])
+        return left + self.expr(depth) + right
+
+    def take(self):
+        self.budget -= 1
+
+    def simple_atom(self):
+        self.take()
+        if self.chance(0.4):
+            return str(self.randint(0, 20))
+        return self.choice(LETTERS)
+
+    # atom: (LETTER | SYMBOL) subexpr? | NUMBER | mathit
+    def atom(self, depth):
+        self.take()
+        r = self.rng.random()
+        if r < 0.45:
+            return self.choice(LETTERS)
+        elif r < 0.75:
+            if self.chance(0.2):
+                return "%d.%d" % (self.randint(0, 99), self.randint(0, 99))
+            return str(self.randint(0, 1000))
+        elif r < 0.93:
+            return self.choice(GREEK)
+        elif r < 0.97:
+            return "\\infty"
+        else:
+            return "\\mathit{%s}" % self.choice(WORDS)
+
+    def subscripted(self, depth):
+        name = self.choice([self.choice(LETTERS), self.choice(GREEK)])
+        self.take()
+        return name + "_" + self.script(depth + 1)
+
+    def func(self, depth):
+        name = self.choice(FUNCS)
+        head = name
+        if name == "\\log" and self.chance(0.4):
+            head += "_{%s}" % self.expr(depth)
+        if self.chance(0.3):
+            head += "^" + self.choice(["2", "{-1}", "{%s}" % self.expr(depth)])
+        if self.chance(0.5):
+            return "%s(%s)" % (head, self.expr(depth))
+        # func_arg_noparens: mp_nofunc, kept to a single atom
+        return "%s %s" % (head, self.simple_atom())
+
+    def var(self):
+        return self.choice([self.choice(LETTERS), self.choice(GREEK)])
+
+    def integral(self, depth):
+        var = self.var()
+        head = "\\int"
+        if self.chance(0.5):
+            lower = "_" + self.script(depth)
+            upper = "^" + self.script(depth)
+            head += lower + upper if self.chance(0.5) else upper + lower
+        if self.chance(0.2):
+            # integrand written as a fraction with the differential on top
+            return "%s \\frac{%s}{%s}" % (head, "d" + var,
+                self.expr(depth))
+        return "%s %s %s" % (head, self.expr(depth), "d" + var)
+
+    def sum_or_prod(self, depth):
+        head = self.choice(["\\sum", "\\prod"])
+        sub = "_{%s = %s}" % (self.choice(LETTERS), self.expr(depth))
+        sup = "^" + self.script(depth)
+        if self.chance(0.5):
+            head += sub + sup
+        else:
+            head += sup + sub
+        return "%s %s" % (head, self.postfix(depth))
+
+    def limit(self, depth):
+        approaching = self.simple_atom()
+        if self.chance(0.3):
+            approaching += self.choice(["^{+}", "^{-}"])
+        return "\\lim_{%s %s %s} %s" % (self.var(), self.choice(LIM_APPROACH),
+            approaching, self.postfix(depth))
+
+    def derivative(self, depth):
+        var = self.var()
+        if self.chance(0.2):
+            return "\\frac{\\partial}{\\partial %s} %s" % (var, self.group(depth))
+        if self.chance(0.3):
+            return "\\frac{d %s}{%s}" % (self.group(depth), "d" + var)
+        return "\\frac{d}{%s} %s" % ("d" + var, self.group(depth))
+
+    def eval_at(self, depth):
+        def side():
+            if self.chance(0.7):
+                return "{%s=%s}" % (self.choice(LETTERS), self.expr(depth))
+            return "{%s}" % self.expr(depth)
+        base = "(%s)|" % self.expr(depth)
+        r = self.rng.random()
+        if r < 0.4:
+            # eval_at: BAR (eval_at_sup | eval_at_sub | eval_at_sup eval_at_sub)
+            return base + "^" + side() + "_" + side()
+        elif r < 0.7:
+            return base + "^" + side()
+        return base + "_" + side()
+
+
+def mutate(latex, rng):
+    """Corrupt a valid expression. The result is usually, not always, invalid."""
+    gen = ExprGenerator(rng)
+    n = len(latex)
+    op = gen.randint(0, 4)
+    if op == 0 and n > 1:
+        # drop a slice
+        i = gen.randint(0, n - 1)
+        return latex[:i] + latex[i + gen.randint(1, 4):]
+    elif op == 1:
+        i = gen.randint(0, n)
+        return latex[:i] + gen.choice(BAD_TOKENS) + latex[i:]
+    elif op == 2 and n > 1:
+        # truncate
+        return latex[:gen.randint(0, n - 1)]
+    elif op == 3:
+        # unbalance a bracket
+        for c in "{}()|":
+            if c in latex and gen.chance(0.5):
+                i = latex.index(c)
+                return latex[:i] + latex[i + 1:]
+        return latex + gen.choice("{(|")
+    return latex + " " + gen.choice(BAD_TOKENS)
+
+
+def parse_weight(text):
+    """Parse a ``construct=value`` weight override, for argparse."""
+    name, sep, value = text.partition("=")
+    if not sep or name not in DEFAULT_WEIGHTS:
+        raise argparse.ArgumentTypeError("expected construct=value with a "
+            "construct from: %s" % ", ".join(sorted(DEFAULT_WEIGHTS)))
+    try:
+        return name, float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("weight of %s must be a number" % name)
+
+def case_rng(seed, index):
+    return random.Random(seed * 1000003 + index)
+
+def generate_case(seed, index, invalid=0.0, **config):
+    """Return (kind, latex) for one case; kind is 'valid' or 'mutated'."""
+    rng = case_rng(seed, index)
+    latex = ExprGenerator(rng, **config).math()
+    if rng.random() < invalid:
+        return "mutated", mutate(latex, rng)
+    return "valid", latex
+
+def generate_cases(seed=0, count=None, start=0, invalid=0.0, **config):
+    """Yield (index, kind, latex); runs forever when count is None."""
+    index = start
+    while count is None or index < start + count:
+        kind, latex = generate_case(seed, index, invalid, **config)
+        yield index, kind, latex
+        index += 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print random LaTeX expressions.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--count", type=int, default=20)
+    parser.add_argument("--size", type=int, default=20)
+    parser.add_argument("--max-depth", type=int, default=6)
+    parser.add_argument("--invalid", type=float, default=0.0,
+        help="fraction of cases to mutate into (usually) invalid input")
+    parser.add_argument("--weight", type=parse_weight, action="append",
+        default=[], metavar="CONSTRUCT=VALUE",
+        help="override a construct's weight, 0 turns it off; repeatable")
+    args = parser.parse_args()
+    for index, kind, latex in generate_cases(args.seed, args.count,
+            invalid=args.invalid, size=args.size, max_depth=args.max_depth,
+            weights=dict(args.weight)):
+        sys.stdout.write("%d\t%s\t%s\n" % (index, kind, latex))
@@ -0,0 +1,313 @@
+"""Local JSON-RPC service in front of a pool of warm latex_worker processes.
+
+Speaks line-delimited JSON-RPC 2.0 over TCP or a Unix socket:
+
+    {"jsonrpc": "2.0", "id": 1, "method": "parse", "params": {"latex": "x^2"}}
+
+Methods are "parse" (returns the str() of process_sympy's result),
+"validate" (returns true or an error) and "stats". The server itself needs
+Python 3, while the parser only runs on Python 2, so the workers run under
+the interpreter given with --python.
+"""
+import argparse
+import asyncio
+import bisect
+import json
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+WORKER = os.path.join(HERE, "latex_worker.py")
+
+# upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+class RequestTimeout(Exception):
+    pass
+
+
+class WorkerError(Exception):
+    pass
+
+
+class Worker(object):
+    def __init__(self, python):
+        self.python = python
+        self.proc = None
+        # replacement being warmed up in the background, see respawn
+        self.starting = None
+
+    def alive(self):
+        return self.proc is not None and self.proc.returncode is None
+
+    async def start(self):
+        try:
+            self.proc = await asyncio.create_subprocess_exec(
+                self.python, WORKER, cwd=HERE,
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+        except OSError as e:
+            raise WorkerError("cannot run %s: %s" % (self.python, e))
+        line = await self.proc.stdout.readline()
+        try:
+            status = json.loads(line.decode("utf-8"))
+        except ValueError:
+            status = {"error": "worker exited during startup"}
+        if not status.get("ready"):
+            await self.kill()
+            raise WorkerError("worker failed to start under %s: %s" % (
+                self.python, status.get("error")))
+
+    async def kill(self):
+        starting, self.starting = self.starting, None
+        if starting is not None:
+            starting.cancel()
+            try:
+                await starting
+            except asyncio.CancelledError:
+                pass
+        proc, self.proc = self.proc, None
+        if proc is not None and proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+
+    async def restart(self):
+        try:
+            await self.start()
+        except WorkerError as e:
+            # the slot stays empty and the next call tries again
+            print("latex_server: %s" % e, file=sys.stderr)
+
+    async def respawn(self):
+        # kill the worker now, but warm its replacement up in the background
+        # so the failed request's reply doesn't wait for it
+        await self.kill()
+        self.starting = asyncio.ensure_future(self.restart())
+
+    async def call(self, req, timeout):
+        if self.starting is not None:
+            starting, self.starting = self.starting, None
+            await starting
+        if not self.alive():
+            await self.start()
+        try:
+            self.proc.stdin.write((json.dumps(req) + "\n").encode("utf-8"))
+            await self.proc.stdin.drain()
+            line = await asyncio.wait_for(self.proc.stdout.readline(), timeout)
+            if not line:
+                raise WorkerError("worker died")
+            return json.loads(line.decode("utf-8"))
+        except asyncio.TimeoutError:
+            # the worker is stuck in a runaway parse; replace it
+            await self.respawn()
+            raise RequestTimeout("request timed out after %gs" % timeout)
+        except WorkerError:
+            await self.respawn()
+            raise
+        except (OSError, ValueError) as e:
+            # broken pipe or a garbled reply; the worker can't be trusted
+            await self.respawn()
+            raise WorkerError("worker failed: %s" % e)
+
+
+class Stats(object):
+    def __init__(self):
+        self.started = time.time()
+        self.completed = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.coalesced = 0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, latency, reply):
+        self.completed += 1
+        if "error" in reply:
+            self.errors += 1
+        ms = latency * 1000.0
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, ms)] += 1
+
+    def as_dict(self, queue_depth, in_flight):
+        uptime = time.time() - self.started
+        labels = ["<=%dms" % b for b in LATENCY_BUCKETS] + [">%dms" % LATENCY_BUCKETS[-1]]
+        return {
+            "uptime": uptime,
+            "completed": self.completed,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "coalesced": self.coalesced,
+            "throughput": self.completed / uptime if uptime else 0.0,
+            "queue_depth": queue_depth,
+            "in_flight": in_flight,
+            "latency_histogram": [list(b) for b in zip(labels, self.histogram)],
+        }
+
+
+class Pool(object):
+    def __init__(self, python, workers, queue_size, timeout):
+        self.python = python
+        self.size = workers
+        self.timeout = timeout
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.in_flight = {}
+        self.stats = Stats()
+        self.workers = []
+        self.tasks = []
+
+    async def start(self):
+        for i in range(self.size):
+            worker = Worker(self.python)
+            await worker.start()
+            self.workers.append(worker)
+            self.tasks.append(asyncio.ensure_future(self.run(worker)))
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        for worker in self.workers:
+            await worker.kill()
+
+    async def run(self, worker):
+        while True:
+            key, future, queued = await self.queue.get()
+            method, latex = key
+            try:
+                reply = await worker.call(
+                    {"method": method, "latex": latex}, self.timeout)
+            except RequestTimeout as e:
+                self.stats.timeouts += 1
+                reply = {"error": str(e)}
+            except Exception as e:
+                reply = {"error": str(e)}
+            self.stats.record(time.time() - queued, reply)
+            if not future.done():
+                future.set_result(reply)
+            self.queue.task_done()
+
+    async def enqueue(self, method, latex):
+        """Queue a request and return the future its reply will be set on."""
+        key = (method, latex)
+        future = self.in_flight.get(key)
+        if future is not None:
+            # identical request already queued or running, share its reply
+            self.stats.coalesced += 1
+            return future
+
+        future = asyncio.get_event_loop().create_future()
+        self.in_flight[key] = future
+        future.add_done_callback(lambda f: self.in_flight.pop(key, None))
+        # blocks while the queue is full
+        await self.queue.put((key, future, time.time()))
+        return future
+
+    def stats_dict(self):
+        return self.stats.as_dict(self.queue.qsize(), len(self.in_flight))
+
+
+def rpc_error(req_id, code, message):
+    return {"jsonrpc": "2.0", "id": req_id,
+            "error": {"code": code, "message": message}}
+
+def rpc_result(req_id, reply):
+    if "error" in reply:
+        return rpc_error(req_id, 1, reply["error"])
+    return {"jsonrpc": "2.0", "id": req_id, "result": reply["result"]}
+
+async def finish(req_id, future):
+    return rpc_result(req_id, await asyncio.shield(future))
+
+async def dispatch(pool, req):
+    """Queue req and return a future for its JSON-RPC reply."""
+    done = asyncio.get_event_loop().create_future()
+    if not isinstance(req, dict):
+        done.set_result(rpc_error(None, -32700, "parse error"))
+        return done
+
+    req_id = req.get("id")
+    method = req.get("method")
+    params = req.get("params") or {}
+    latex = params.get("latex") if isinstance(params, dict) else None
+    if method == "stats":
+        done.set_result({"jsonrpc": "2.0", "id": req_id,
+                         "result": pool.stats_dict()})
+    elif method not in ("parse", "validate"):
+        done.set_result(rpc_error(req_id, -32601, "unknown method %s" % method))
+    elif not isinstance(latex, str):
+        done.set_result(rpc_error(req_id, -32602, "params.latex must be a string"))
+    else:
+        future = await pool.enqueue(method, latex)
+        return asyncio.ensure_future(finish(req_id, future))
+    return done
+
+async def respond(reply, writer, lock):
+    reply = await reply
+    async with lock:
+        writer.write((json.dumps(reply) + "\n").encode("utf-8"))
+        await writer.drain()
+
+def handler(pool):
+    async def handle(reader, writer):
+        lock = asyncio.Lock()
+        pending = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    req = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    req = None
+                # waiting here while the pool's queue is full stops us reading
+                # from the socket, which pushes back on the client
+                reply = await dispatch(pool, req)
+                task = asyncio.ensure_future(respond(reply, writer, lock))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.wait(pending)
+        finally:
+            writer.close()
+    return handle
+
+async def serve(args):
+    pool = Pool(args.python, args.workers, args.queue_size, args.timeout)
+    try:
+        await pool.start()
+        if args.unix:
+            server = await asyncio.start_unix_server(handler(pool), path=args.unix)
+        else:
+            server = await asyncio.start_server(handler(pool), args.host, args.port)
+        print("latex_server listening on %s with %d workers" % (
+            args.unix or "%s:%d" % (args.host, args.port), args.workers))
+        try:
+            await server.serve_forever()
+        finally:
+            server.close()
+    finally:
+        await pool.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--queue-size", type=int, default=1024)
+    parser.add_argument("--timeout", type=float, default=5.0,
+        help="seconds before a request's worker is killed")
+    parser.add_argument("--python", required=True,
+        help="Python 2 interpreter used to run the workers")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args))
+    except WorkerError as e:
+        sys.exit("latex_server: %s" % e)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
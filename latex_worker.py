@@ -0,0 +1,64 @@
+"""Worker process for latex_server.
+
+Reads one JSON request per line on stdin and writes one JSON reply per line
+on stdout. A request is {"method": "parse" | "validate", "latex": "..."};
+the reply is {"result": ...} or {"error": "..."}.
+"""
+import json
+import sys
+
+try:
+    from process_latex import process_sympy
+    from latex_ast import parse_latex_ast
+    startup_error = None
+except Exception as e:
+    # reported to the server in place of the ready line, usually because
+    # the worker was started under Python 3
+    startup_error = "%s: %s" % (type(e).__name__, e)
+
+# parsed once at startup so the first real request doesn't pay for imports
+# and the parser's cold DFA
+WARMUP = "\\frac{d}{dx} \\int_{0}^{1} \\sin^{2} x + \\sqrt{y} dx"
+
+def handle(req):
+    method = req.get("method", "parse")
+    latex = req.get("latex")
+    if not isinstance(latex, (type(u""), str)):
+        return {"error": "latex must be a string"}
+    try:
+        if method == "parse":
+            return {"result": str(process_sympy(latex))}
+        elif method == "validate":
+            parse_latex_ast(latex)
+            return {"result": True}
+        else:
+            return {"error": "unknown method %s" % method}
+    except Exception as e:
+        return {"error": str(e)}
+
+def main():
+    error = startup_error
+    if error is None:
+        try:
+            process_sympy(WARMUP)
+        except Exception as e:
+            error = "warm-up parse failed: %s" % e
+    if error is not None:
+        sys.stdout.write(json.dumps({"error": "cannot load the parser under Python %d.%d: %s"
+            % (sys.version_info[0], sys.version_info[1], error)}) + "\n")
+        sys.stdout.flush()
+        return 1
+
+    sys.stdout.write(json.dumps({"ready": True}) + "\n")
+    sys.stdout.flush()
+
+    for line in iter(sys.stdin.readline, ""):
+        try:
+            reply = handle(json.loads(line))
+        except ValueError:
+            reply = {"error": "invalid JSON"}
+        sys.stdout.write(json.dumps(reply) + "\n")
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    sys.exit(main())
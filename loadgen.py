@@ -0,0 +1,108 @@
+"""Load generator for latex_server.
+
+Opens several connections, sends parse requests as fast as the server
+accepts them and reports client-side throughput and latency percentiles,
+followed by the server's own stats.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+
+EXPRESSIONS = [
+    "x^{3 + 1}",
+    "\\frac{a + b}{c}",
+    "\\sin^{-1} a + \\cos b",
+    "\\int_{a}^{b} x^2 dx",
+    "\\sum_{k = 1}^{10} k^2",
+    "\\lim_{x \\to \\infty} \\frac{1}{x}",
+    "\\frac{d}{dx} [ \\tan x ]",
+    "(2x^3 - x + z)|_{x=3}",
+    "\\sqrt[3]{\\sin x} \\cdot \\log_{2} y",
+    "f(x, y) = \\int \\frac{dz}{z}",
+]
+
+async def open_connection(args):
+    if args.unix:
+        return await asyncio.open_unix_connection(args.unix)
+    return await asyncio.open_connection(args.host, args.port)
+
+async def call(reader, writer, req):
+    writer.write((json.dumps(req) + "\n").encode("utf-8"))
+    await writer.drain()
+    return json.loads((await reader.readline()).decode("utf-8"))
+
+async def client(args, index, ids, latencies, errors):
+    reader, writer = await open_connection(args)
+    rng = random.Random(args.seed * 1000003 + index)
+    # at most --pipeline requests outstanding on this connection
+    window = asyncio.Semaphore(args.pipeline)
+    pending = {}
+
+    async def read_replies():
+        for i in range(args.requests):
+            reply = json.loads((await reader.readline()).decode("utf-8"))
+            latencies.append(time.time() - pending.pop(reply["id"]))
+            if "error" in reply:
+                errors.append(reply["error"]["message"])
+            window.release()
+
+    reading = asyncio.ensure_future(read_replies())
+    for i in range(args.requests):
+        await window.acquire()
+        req_id = next(ids)
+        latex = rng.choice(EXPRESSIONS)
+        if args.unique:
+            latex += " + %d" % req_id
+        pending[req_id] = time.time()
+        writer.write((json.dumps({"jsonrpc": "2.0", "id": req_id,
+            "method": "parse", "params": {"latex": latex}}) + "\n").encode("utf-8"))
+        await writer.drain()
+    await reading
+    writer.close()
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+async def run(args):
+    ids = itertools.count(1)
+    latencies = []
+    errors = []
+    started = time.time()
+    await asyncio.gather(*[client(args, i, ids, latencies, errors)
+                           for i in range(args.connections)])
+    elapsed = time.time() - started
+
+    latencies.sort()
+    print("%d requests in %.2fs: %.1f req/s, %d errors" % (
+        len(latencies), elapsed, len(latencies) / elapsed, len(errors)))
+    for p in (50, 90, 99, 99.9):
+        print("  p%-5s %8.2f ms" % (p, 1000.0 * percentile(latencies, p)))
+
+    reader, writer = await open_connection(args)
+    stats = await call(reader, writer, {"jsonrpc": "2.0", "id": 0, "method": "stats"})
+    writer.close()
+    print(json.dumps(stats["result"], indent=2, sort_keys=True))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", help="connect to this Unix socket instead of TCP")
+    parser.add_argument("--connections", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=1000,
+        help="requests per connection")
+    parser.add_argument("--pipeline", type=int, default=16,
+        help="outstanding requests per connection")
+    parser.add_argument("--unique", action="store_true",
+        help="make every expression distinct so nothing is coalesced")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
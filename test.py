@@ -1,7 +1,14 @@
+import gc
+
+from antlr4 import ParserRuleContext
+from antlr4.Token import CommonToken
 from sympy import *
 from sympy.abc import x,y,z,a,b,c,f,t,k,n
 
 from process_latex import process_sympy
+from latex_ast import parse_latex_ast
+from latex_gen import generate_cases
+from latex_bulk import parse_bulk, reset_dfa
 
 theta = Symbol('theta')
 
@@ -90,6 +97,8 @@ GOOD_PAIRS = [
     ("\\int \\frac{1}{a} + \\frac{1}{b} dx", Integral(_Add(_Pow(a,-1), Pow(b,-1)),x)),
     ("\\int \\frac{3 \cdot d\\theta}{\\theta}", Integral(3*_Pow(theta,-1), theta)),
     ("\\int \\frac{1}{x} + 1 dx", Integral(_Add(_Pow(x, -1), 1), x)),
+    ("\\int \\delta x", Integral(Symbol('delta')*x, x)),
+    ("2 x \\int_0^1 y dy", _Mul(2, _Mul(x, Integral(y, (y, 0, 1))))),
     ("x_0", Symbol('x_{0}')),
     ("x_{1}", Symbol('x_{1}')),
     ("x_a", Symbol('x_{a}')),
@@ -139,7 +148,32 @@ GOOD_PAIRS = [
     ("\\log_{a^2} x", _log(x, _Pow(a, 2))),
     ("[x]", x),
     ("[a + b]", _Add(a, b)),
-    ("\\frac{d}{dx} [ \\tan x ]", Derivative(tan(x), x))
+    ("\\frac{d}{dx} [ \\tan x ]", Derivative(tan(x), x)),
+    ("(x^2)|_{x^2=y}", y),
+    ("(\\int x dx)|_{x=1}", Integral(x, (x, 1)))
+]
+
+# With evaluate=True these should parse to the canonical SymPy expression
+EVALUATED_PAIRS = [
+    ("-3.14", -3.14),
+    ("\\frac{7}{3}", Rational(7, 3)),
+    ("a + b - a", b),
+    ("x - x", 0),
+    ("1 + 2 + 3 + a", a + 6),
+    ("a - (b - c)", a - b + c),
+    ("a \\cdot b / a", b),
+    ("a / b / c", a / (b * c)),
+    ("a / (b / c)", a * c / b),
+    ("2 3 x", 6*x),
+    ("x^{3 + 1}", x**4),
+    ("-c", -c),
+    ("\\frac{a + b}{c}", (a + b) / c),
+    ("\\sin^{-1} a", asin(a)),
+    ("5!", 120),
+    ("|-2|", 2),
+    ("\\int x + a - x dx", Integral(a, x)),
+    ("\\frac{d (x + x)}{dx}", Derivative(2*x, x)),
+    ("(2x^3 - x + z)|_{x=3}", z + 51),
 ]
 
 # These bad latex strings should raise an exception when parsed
@@ -205,5 +239,81 @@ for s in BAD_STRINGS:
         print("ERROR: Exception should have been raised for \"%s\"" % s)
     except Exception:
         passed += 1 
+for s, eq in EVALUATED_PAIRS:
+    total += 1
+    try:
+        if process_sympy(s, evaluate=True) != eq:
+            print("ERROR: \"%s\" did not evaluate to %s" % (s, eq))
+        else:
+            passed += 1
+    except Exception as e:
+        print("ERROR: Exception when evaluating \"%s\"" % s)
+# the lazy AST should materialize to the same expressions
+for s, eq in GOOD_PAIRS:
+    total += 1
+    try:
+        ast = parse_latex_ast(s)
+        if ast.to_sympy() != eq:
+            print("ERROR: AST of \"%s\" did not materialize to %s" % (s, eq))
+        elif ast.free_symbols() != set(str(sym) for sym in sympify(eq).free_symbols):
+            print("ERROR: AST of \"%s\" has free symbols %s" % (s, ast.free_symbols()))
+        else:
+            passed += 1
+    except Exception as e:
+        print("ERROR: Exception when building AST of \"%s\"" % s)
+# on generated expressions the AST's free symbols should cover those of the
+# materialized expression, which SymPy may have simplified some away from
+for index, kind, s in generate_cases(seed=0, count=200):
+    try:
+        ast = parse_latex_ast(s)
+        expected = set(str(sym) for sym in sympify(ast.to_sympy()).free_symbols)
+    except Exception:
+        continue # the generator can build LaTeX the grammar rejects
+    total += 1
+    if not ast.free_symbols() >= expected:
+        print("ERROR: AST of generated case %d \"%s\" has free symbols %s" % (index, s, ast.free_symbols()))
+    else:
+        passed += 1
+def srepr_or_error(parse, s):
+    try:
+        return srepr(parse(s))
+    except Exception:
+        return None
+# bulk parsing should give the same results, and raise nothing itself,
+# even with the DFA cache reset after every parse
+reset_dfa()
+sources = [s for s, eq in GOOD_PAIRS] + BAD_STRINGS
+for s, result in zip(sources, parse_bulk(sources, max_dfa_states=0, check_every=1)):
+    total += 1
+    actual = None if isinstance(result, Exception) else srepr(result)
+    if actual != srepr_or_error(process_sympy, s):
+        print("ERROR: bulk parse of \"%s\" gave %s" % (s, result))
+    else:
+        passed += 1
+# parses should leave no ANTLR objects for the cyclic garbage collector,
+# including derivative numerators, which are parsed on their own
+def parser_objects():
+    return sum(1 for obj in gc.get_objects()
+               if isinstance(obj, (ParserRuleContext, CommonToken)))
+def parse_quietly(s):
+    # the traceback, and the parser frames in it, go away when this returns
+    try:
+        process_sympy(s)
+    except Exception:
+        pass
+for s in ["\\frac{d x^2}{dx}", "\\frac{\\partial x^2}{\\partial x}"] + BAD_STRINGS:
+    total += 1
+    gc.collect()
+    gc.disable()
+    try:
+        before = parser_objects()
+        parse_quietly(s)
+        left = parser_objects() - before
+    finally:
+        gc.enable()
+    if left:
+        print("ERROR: parsing \"%s\" left %d ANTLR objects behind" % (s, left))
+    else:
+        passed += 1
 
 print("%d/%d STRINGS PASSED" % (passed, total))